@@ -1,26 +1,116 @@
 from google_auth_oauthlib.flow import Flow
+from google.auth import _helpers as _google_auth_helpers
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google.oauth2.credentials import Credentials
+from cachetools import TTLCache
+from datetime import datetime, timedelta, timezone
 from .config import settings
+import asyncio
 import os
+import secrets
+import threading
+import weakref
 
-# Allow HTTP for local testing
-os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+# Allow HTTP only when the redirect itself is plain HTTP (local testing)
+if settings.REDIRECT_URI.startswith("http://"):
+    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 
-def create_flow():
-    # In a real app, you would load client_secrets.json or construct from env vars
-    # Here we assume env vars are mapped to a client config dict
-    client_config = {
-        "web": {
-            "client_id": settings.GOOGLE_CLIENT_ID,
-            "client_secret": settings.GOOGLE_CLIENT_SECRET,
-            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
-        }
+# In a real app, you would load client_secrets.json or construct from env vars
+# Here we assume env vars are mapped to a client config dict
+_CLIENT_CONFIG = {
+    "web": {
+        "client_id": settings.GOOGLE_CLIENT_ID,
+        "client_secret": settings.GOOGLE_CLIENT_SECRET,
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token",
     }
-    
+}
+
+def create_flow():
+    # Flow keeps per-login state (code verifier, fetched token), so build a new one each time
     flow = Flow.from_client_config(
-        client_config,
+        _CLIENT_CONFIG,
         scopes=settings.SCOPES
     )
     # Force the redirect_uri to be exactly what is in the console
     flow.redirect_uri = settings.REDIRECT_URI
     return flow
+
+# Access tokens are kept server-side, keyed by a random session id. The session
+# cookie only carries that id and the refresh token, so it stays small and an
+# expired or evicted entry is rebuilt by refreshing.
+SESSION_TTL = 3600  # Google access tokens live for an hour
+_SESSIONS = TTLCache(maxsize=4096, ttl=SESSION_TTL)
+_SESSIONS_LOCK = threading.Lock()
+
+def store_credentials(creds, user_id=None) -> dict:
+    """Keeps the access token server-side and returns the dict to store in the session."""
+    sid = secrets.token_urlsafe(16)
+    with _SESSIONS_LOCK:
+        _SESSIONS[sid] = {"token": creds.token, "expiry": creds.expiry, "scopes": creds.scopes}
+    return {"sid": sid, "refresh_token": creds.refresh_token, "user_id": user_id}
+
+def get_stored_credentials(sid):
+    """Returns the server-side credentials for a session id, or None if they expired."""
+    with _SESSIONS_LOCK:
+        return _SESSIONS.get(sid)
+
+def discard_credentials(sid):
+    with _SESSIONS_LOCK:
+        _SESSIONS.pop(sid, None)
+
+# Tokens this close to expiry are refreshed before use, so API calls never hit a 401.
+# It must exceed google-auth's own threshold (REFRESH_THRESHOLD, 3m45s), or the
+# shared client's Credentials would refresh themselves first, in every worker
+# thread, outside the per-session lock and without updating the store.
+REFRESH_MARGIN = _google_auth_helpers.REFRESH_THRESHOLD + timedelta(seconds=60)
+# One lock per session id, so concurrent requests share a single refresh
+_REFRESH_LOCKS = weakref.WeakValueDictionary()
+
+def _is_expiring(token, expiry) -> bool:
+    if not token or expiry is None:
+        return True
+    # google-auth uses naive UTC datetimes for expiry
+    return expiry - datetime.now(timezone.utc).replace(tzinfo=None) < REFRESH_MARGIN
+
+async def ensure_fresh_token(token_info: dict) -> dict:
+    """
+    Refreshes the session's access token if it is missing or about to expire and
+    returns token_info with the current token. Raises RefreshError if Google rejects
+    the refresh token.
+    """
+    sid = token_info.get('sid')
+    # Sessions without an id have nowhere to keep a refreshed token; their client
+    # refreshes on its first request instead.
+    if not sid or not _is_expiring(token_info['access_token'], token_info.get('expiry')):
+        return token_info
+
+    lock = _REFRESH_LOCKS.get(sid)
+    if lock is None:
+        lock = _REFRESH_LOCKS[sid] = asyncio.Lock()
+
+    async with lock:
+        # Another request may have refreshed while we waited for the lock
+        stored = get_stored_credentials(sid)
+        if stored is None or _is_expiring(stored['token'], stored.get('expiry')):
+            creds = Credentials(
+                token=None,
+                refresh_token=token_info['refresh_token'],
+                token_uri="https://oauth2.googleapis.com/token",
+                client_id=token_info['client_id'],
+                client_secret=token_info['client_secret'],
+                scopes=token_info['scopes']
+            )
+            await asyncio.to_thread(creds.refresh, GoogleAuthRequest())
+            stored = {"token": creds.token, "expiry": creds.expiry, "scopes": token_info['scopes']}
+            if creds.refresh_token:
+                stored["refresh_token"] = creds.refresh_token
+            with _SESSIONS_LOCK:
+                _SESSIONS[sid] = stored
+
+    return {
+        **token_info,
+        'access_token': stored['token'],
+        'expiry': stored['expiry'],
+        'refresh_token': stored.get('refresh_token') or token_info['refresh_token']
+    }
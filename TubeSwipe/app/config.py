@@ -17,6 +17,16 @@ class Settings:
     # If keys are missing, default to Mock Mode
     MOCK_MODE = os.getenv("MOCK_MODE", "False").lower() == "true" or not GOOGLE_CLIENT_ID
 
+    # Caches are kept out of the source tree by default
+    CACHE_ROOT = os.path.join(
+        os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+        "tubeswipe"
+    )
+    # Cached YouTube API responses
+    HTTP_CACHE_DIR = os.getenv("HTTP_CACHE_DIR") or os.path.join(CACHE_ROOT, "http")
+    # Cached video durations (SQLite)
+    VIDEO_DURATIONS_DB = os.getenv("VIDEO_DURATIONS_DB") or os.path.join(CACHE_ROOT, "video_durations.db")
+
     # OpenAI Key for summaries
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     
@@ -1,26 +1,43 @@
 from fastapi import FastAPI, Request, Depends, HTTPException
-from fastapi.responses import RedirectResponse, HTMLResponse
+from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
 from pydantic import BaseModel
+import logging
+import orjson
 from app.config import settings
 from app.models import SwipeAction
 
 from google.auth.exceptions import RefreshError
 from app.services.youtube import (
-    get_youtube_client, 
-    get_feed, 
+    get_feed_json, 
     get_or_create_playlist, 
     add_video_to_playlist,
+    invalidate_saved_map,
     get_user_playlists,
-    create_playlist
+    create_playlist,
+    get_own_channel_id
 )
+from app.services.client_cache import get_cached_youtube_client
 from app.services.summary import get_video_summary
 from app.services.storage import mute_channel, unmute_channel, load_muted_channels_dict
-from app.auth import create_flow
+from app.auth import create_flow, store_credentials, discard_credentials, ensure_fresh_token
+from app.middleware import CredentialsExtractionMiddleware
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson, which is several times faster than the stdlib encoder."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Builds request.state.token_info from the session. Added first so that it runs
+# inside SessionMiddleware (the last middleware added is the outermost).
+app.add_middleware(CredentialsExtractionMiddleware)
 # Add session middleware for simple token storage
 app.add_middleware(SessionMiddleware, secret_key=settings.SECRET_KEY)
 
@@ -38,16 +55,21 @@ class CreatePlaylistRequest(BaseModel):
     description: str = "Created via TubeSwipe"
     privacy: str = "private"
 
+# index.html only depends on logged_in, so both variants are rendered once at import.
+# Handlers build a fresh Response from these bytes: Response objects must not be
+# shared, since middleware appends headers (e.g. Set-Cookie) to them.
+_INDEX_HTML = {
+    logged_in: templates.get_template("index.html").render(logged_in=logged_in).encode()
+    for logged_in in (False, True)
+}
+
 @app.get("/favicon.ico", include_in_schema=False)
 async def favicon():
-    return HTMLResponse("")
+    return Response(status_code=204)
 
 @app.get("/")
-def home(request: Request):
-    # Check if logged in
-    if "credentials" not in request.session:
-        return templates.TemplateResponse(request=request, name="index.html", context={"logged_in": False})
-    return templates.TemplateResponse(request=request, name="index.html", context={"logged_in": True})
+async def home(request: Request):
+    return HTMLResponse(_INDEX_HTML["credentials" in request.session])
 
 @app.get("/login")
 def login(request: Request):
@@ -66,21 +88,15 @@ def login(request: Request):
 @app.get("/auth/callback")
 def auth_callback(request: Request):
     if request.query_params.get("mock"):
-        request.session["credentials"] = {
-            "mock": True,
-            "token": "mock_token",
-            "refresh_token": "mock_refresh",
-            "scopes": []
-        }
+        request.session["credentials"] = {"mock": True}
         return RedirectResponse("/")
 
     state = request.session.get("state")
     if not state:
         raise HTTPException(status_code=400, detail="State missing")
         
+    # create_flow sets the same redirect_uri that was used in the authorization step
     flow = create_flow()
-    # IMPORTANT: The redirect_uri here must match exactly what was used in the authorization step
-    flow.redirect_uri = settings.REDIRECT_URI
     
     # Use the full URL from the request to fetch the token
     # We need to ensure it starts with https if running behind a proxy, but for localhost http is fine
@@ -94,190 +110,118 @@ def auth_callback(request: Request):
     
     creds = flow.credentials
     
-    # Store credentials in session (In prod, store in DB and use session ID)
-    request.session["credentials"] = {
-        "token": creds.token,
-        "refresh_token": creds.refresh_token,
-        "token_uri": creds.token_uri,
-        "client_id": creds.client_id,
-        "client_secret": creds.client_secret,
-        "scopes": creds.scopes
-    }
+    # Keep the tokens server-side; the session only gets an id, the refresh token
+    # and the channel ID that keys per-user data such as the HTTP cache
+    request.session["credentials"] = store_credentials(creds, get_own_channel_id(creds))
+    request.session.pop("state", None)
     
     return RedirectResponse("/")
 
-@app.get("/api/feed")
-async def get_video_feed(request: Request, include_shorts: bool = True, playlist_id: str = None, refresh: bool = False):
-    if "credentials" not in request.session:
+async def get_token_info(request: Request) -> dict:
+    """Dependency: the caller's token_info, or 401 if they are not logged in."""
+    token_info = request.state.token_info
+    if token_info is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
-        
-    creds_dict = request.session["credentials"]
-    
-    if creds_dict.get("mock"):
-        token_info = {"mock": True}
-    else:
-        # Reconstruct credentials dict for our service helper
-        # Note: The dict structure in session matches what Credentials expects mostly, 
-        # but we need to map it correctly in services.py
-        
-        # We need to pass the client_id/secret again because they might not be in the creds object directly 
-        # depending on how it was created, but we stored them.
-        token_info = {
-            'access_token': creds_dict['token'],
-            'refresh_token': creds_dict['refresh_token'],
-            'client_id': settings.GOOGLE_CLIENT_ID,
-            'client_secret': settings.GOOGLE_CLIENT_SECRET,
-            'scopes': creds_dict['scopes']
-        }
-    
+    return token_info
+
+async def get_yt(request: Request, token_info: dict = Depends(get_token_info)):
+    """Dependency: the YouTube client for this request, with a token that is not about to expire."""
+    if hasattr(request.state, "youtube"):
+        return request.state.youtube
+
+    try:
+        fresh = await ensure_fresh_token(token_info)
+    except RefreshError:
+        # Drop the dead server-side tokens too, as logout does
+        if token_info.get("sid"):
+            discard_credentials(token_info["sid"])
+        request.session.clear()
+        raise HTTPException(status_code=401, detail="Session expired, please login again")
+    if fresh.get('refresh_token') != token_info.get('refresh_token'):
+        # Google rotated the refresh token; keep the cookie in sync
+        request.session["credentials"] = {"sid": fresh['sid'], "refresh_token": fresh['refresh_token'], "user_id": fresh.get('user_id')}
+
+    request.state.youtube = await run_in_threadpool(get_cached_youtube_client, fresh)
+    return request.state.youtube
+
+@app.get("/api/feed")
+async def get_video_feed(request: Request, include_shorts: bool = True, playlist_id: str = None, refresh: bool = False, youtube=Depends(get_yt), token_info: dict = Depends(get_token_info)):
     try:
-        youtube = get_youtube_client(token_info)
         # Handle empty string playlist_id
         if not playlist_id:
             playlist_id = None
             
-        videos = await get_feed(youtube, include_shorts=include_shorts, check_playlist_id=playlist_id, force_refresh=refresh)
-        return videos
+        # Feeds are cached per session; sessions without an id are never cached
+        # Feeds come back JSON-encoded (and cached that way), so they skip FastAPI's encoder
+        videos = await get_feed_json(youtube, include_shorts=include_shorts, check_playlist_id=playlist_id, force_refresh=refresh, user_id=token_info.get('user_id'))
+        return Response(content=videos, media_type="application/json")
     except RefreshError:
         # Token expired and refresh failed (likely missing refresh_token)
+        if token_info.get("sid"):
+            discard_credentials(token_info["sid"])
         request.session.clear() # Clear the invalid session
         raise HTTPException(status_code=401, detail="Session expired, please login again")
     except Exception as e:
         # Log the full error for debugging
-        print(f"Error fetching feed: {e}")
+        logger.exception("Error fetching feed: %s", e)
         # Return a more user-friendly error
         raise HTTPException(status_code=500, detail="An error occurred while fetching the video feed.")
 
 @app.post("/api/swipe")
-def swipe_video(action: SwipeAction, request: Request):
-    if "credentials" not in request.session:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-        
+async def swipe_video(action: SwipeAction, youtube=Depends(get_yt), token_info: dict = Depends(get_token_info)):
     if action.action == "skip":
         return {"status": "skipped"}
         
-    if action.action == "save":
-        creds_dict = request.session["credentials"]
-        if creds_dict.get("mock"):
-            token_info = {"mock": True}
-        else:
-            token_info = {
-                'access_token': creds_dict['token'],
-                'refresh_token': creds_dict['refresh_token'],
-                'client_id': settings.GOOGLE_CLIENT_ID,
-                'client_secret': settings.GOOGLE_CLIENT_SECRET,
-                'scopes': creds_dict['scopes']
-            }
-        youtube = get_youtube_client(token_info)
-        
-        if action.playlist_id:
-            playlist_id = action.playlist_id
-        else:
-            playlist_id = get_or_create_playlist(youtube)
-            
-        success = add_video_to_playlist(youtube, playlist_id, action.video_id)
+    # Only the API calls go to the threadpool; the saved-status caches below
+    # are not thread-safe and must be touched on the event loop.
+    if action.playlist_id:
+        playlist_id = action.playlist_id
+    else:
+        playlist_id = await run_in_threadpool(get_or_create_playlist, youtube)
         
-        if success:
-            return {"status": "saved"}
-        else:
-            return {"status": "error", "message": "Could not save video"}
-            
-    return {"status": "invalid_action"}
-
-@app.get("/api/summary/{video_id}")
-def get_summary(video_id: str, request: Request):
-    if "credentials" not in request.session:
-        raise HTTPException(status_code=401, detail="Not authenticated")
+    success = await run_in_threadpool(add_video_to_playlist, youtube, playlist_id, action.video_id)
     
-    creds_dict = request.session["credentials"]
-    
-    if creds_dict.get("mock"):
-        token_info = {"mock": True}
+    if success:
+        if token_info.get('user_id'):
+            invalidate_saved_map(token_info['user_id'])
+        return {"status": "saved"}
     else:
-        token_info = {
-            'access_token': creds_dict['token'],
-            'refresh_token': creds_dict['refresh_token'],
-            'client_id': settings.GOOGLE_CLIENT_ID,
-            'client_secret': settings.GOOGLE_CLIENT_SECRET,
-            'scopes': creds_dict['scopes']
-        }
-    
-    youtube = get_youtube_client(token_info)
-    summary = get_video_summary(video_id, youtube_client=youtube)
+        return {"status": "error", "message": "Could not save video"}
+
+@app.get("/api/summary/{video_id}")
+async def get_summary(video_id: str, youtube=Depends(get_yt)):
+    summary = await get_video_summary(video_id, youtube_client=youtube)
     return {"summary": summary}
 
-@app.post("/api/mute")
-def mute_channel_endpoint(data: MuteRequest, request: Request):
-    if "credentials" not in request.session:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    success = mute_channel(data.channel_id, data.channel_title)
+@app.post("/api/mute", dependencies=[Depends(get_token_info)])
+async def mute_channel_endpoint(data: MuteRequest):
+    success = await mute_channel(data.channel_id, data.channel_title)
     if success:
         return {"status": "muted", "channel": data.channel_title}
     else:
         raise HTTPException(status_code=500, detail="Could not mute channel")
 
-@app.post("/api/unmute")
-def unmute_channel_endpoint(data: UnmuteRequest, request: Request):
-    if "credentials" not in request.session:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    success = unmute_channel(data.channel_id)
+@app.post("/api/unmute", dependencies=[Depends(get_token_info)])
+async def unmute_channel_endpoint(data: UnmuteRequest):
+    success = await unmute_channel(data.channel_id)
     if success:
         return {"status": "unmuted"}
     else:
         raise HTTPException(status_code=500, detail="Could not unmute channel")
 
-@app.get("/api/muted-channels")
-def get_muted_channels(request: Request):
-    if "credentials" not in request.session:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
+@app.get("/api/muted-channels", dependencies=[Depends(get_token_info)])
+def get_muted_channels():
     muted = load_muted_channels_dict()
     # Return as list of objects for easier frontend consumption
     return [{"id": k, "name": v} for k, v in muted.items()]
 
 @app.get("/api/playlists")
-def list_playlists(request: Request):
-    if "credentials" not in request.session:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    creds_dict = request.session["credentials"]
-    
-    if creds_dict.get("mock"):
-        token_info = {"mock": True}
-    else:
-        token_info = {
-            'access_token': creds_dict['token'],
-            'refresh_token': creds_dict['refresh_token'],
-            'client_id': settings.GOOGLE_CLIENT_ID,
-            'client_secret': settings.GOOGLE_CLIENT_SECRET,
-            'scopes': creds_dict['scopes']
-        }
-        
-    youtube = get_youtube_client(token_info)
+def list_playlists(youtube=Depends(get_yt)):
     playlists = get_user_playlists(youtube)
     return playlists
 
 @app.post("/api/playlists")
-def create_new_playlist(data: CreatePlaylistRequest, request: Request):
-    if "credentials" not in request.session:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-        
-    creds_dict = request.session["credentials"]
-    
-    if creds_dict.get("mock"):
-        token_info = {"mock": True}
-    else:
-        token_info = {
-            'access_token': creds_dict['token'],
-            'refresh_token': creds_dict['refresh_token'],
-            'client_id': settings.GOOGLE_CLIENT_ID,
-            'client_secret': settings.GOOGLE_CLIENT_SECRET,
-            'scopes': creds_dict['scopes']
-        }
-        
-    youtube = get_youtube_client(token_info)
+def create_new_playlist(data: CreatePlaylistRequest, youtube=Depends(get_yt)):
     result = create_playlist(youtube, data.title, data.privacy, data.description)
     if result:
         return result
@@ -285,5 +229,8 @@ def create_new_playlist(data: CreatePlaylistRequest, request: Request):
 
 @app.get("/logout")
 def logout(request: Request):
+    sid = request.session.get("credentials", {}).get("sid")
+    if sid:
+        discard_credentials(sid)
     request.session.clear()
     return RedirectResponse("/")
@@ -0,0 +1,45 @@
+from .auth import get_stored_credentials
+from .config import settings
+
+
+def build_token_info(creds_dict):
+    """Maps the credentials stored in the session to the dict get_youtube_client expects."""
+    if not creds_dict:
+        return None
+    if creds_dict.get("mock"):
+        return {"mock": True}
+
+    # Only the session id and refresh token live in the cookie. Without a stored
+    # access token, the client refreshes one on its first request.
+    sid = creds_dict.get('sid')
+    stored = (get_stored_credentials(sid) if sid else None) or {}
+    return {
+        'sid': sid,
+        'access_token': stored.get('token'),
+        'expiry': stored.get('expiry'),
+        'refresh_token': creds_dict['refresh_token'],
+        'user_id': creds_dict.get('user_id'),
+        'client_id': settings.GOOGLE_CLIENT_ID,
+        'client_secret': settings.GOOGLE_CLIENT_SECRET,
+        'scopes': stored.get('scopes') or settings.SCOPES
+    }
+
+
+class CredentialsExtractionMiddleware:
+    """
+    Pure ASGI middleware that builds token_info from the session once per request
+    and exposes it as request.state.token_info (None when not logged in).
+
+    Must sit inside SessionMiddleware so scope["session"] is already populated.
+    Kept as plain ASGI on purpose: BaseHTTPMiddleware wraps every request in extra
+    Request/Response objects and adds measurable latency.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            creds_dict = scope.get("session", {}).get("credentials")
+            scope.setdefault("state", {})["token_info"] = build_token_info(creds_dict)
+        await self.app(scope, receive, send)
@@ -1,7 +1,9 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, ConfigDict
+from typing import Literal, Optional
 
 class VideoCard(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
     video_id: str
     title: str
     channel_title: str
@@ -10,6 +12,8 @@ class VideoCard(BaseModel):
     channel_id: str
 
 class SwipeAction(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
     video_id: str
-    action: str  # "save" or "skip"
+    action: Literal["save", "skip"]
     playlist_id: Optional[str] = None
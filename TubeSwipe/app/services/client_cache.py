@@ -0,0 +1,30 @@
+import hashlib
+import threading
+from cachetools import TTLCache
+from .youtube import get_youtube_client
+
+# Built clients keyed by a hash of the user's tokens. The TTL stays below the
+# 1 hour access token lifetime; until then the client's Credentials refresh
+# themselves if needed. A rotated refresh token hashes to a new key.
+CLIENT_CACHE_TTL = 3000
+_CLIENTS = TTLCache(maxsize=1024, ttl=CLIENT_CACHE_TTL)
+_LOCK = threading.Lock()
+
+def _cache_key(token_info: dict) -> str:
+    raw = f"{token_info['access_token']}\0{token_info.get('refresh_token') or ''}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def get_cached_youtube_client(token_info: dict):
+    """Same as get_youtube_client, but reuses the client built for these tokens."""
+    if token_info.get('mock'):
+        return None
+
+    key = _cache_key(token_info)
+    with _LOCK:
+        youtube = _CLIENTS.get(key)
+    if youtube is None:
+        # Build outside the lock; a concurrent duplicate build is harmless.
+        youtube = get_youtube_client(token_info)
+        with _LOCK:
+            _CLIENTS[key] = youtube
+    return youtube
@@ -1,61 +1,235 @@
-import json
+import asyncio
+import orjson
 import os
 import logging
+import sqlite3
+import threading
+import time
+import aiofiles
+from ..config import settings
 
 # Use absolute path to ensure we always find the file
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # app/
 PROJECT_ROOT = os.path.dirname(BASE_DIR) # project root
 MUTED_CHANNELS_FILE = os.path.join(PROJECT_ROOT, 'muted_channels.json')
+# Mutes/unmutes are appended here and folded into MUTED_CHANNELS_FILE once the
+# log grows past COMPACT_THRESHOLD lines, so a single action never rewrites the whole list.
+MUTED_CHANNELS_LOG = os.path.join(PROJECT_ROOT, 'muted_channels.jsonl')
+COMPACT_THRESHOLD = 500
+# Video durations never change once published, so they are kept across restarts
+# (in settings.VIDEO_DURATIONS_DB); expired rows are deleted at most once per interval.
+DURATION_CACHE_TTL = 30 * 86400  # 30 days in seconds
+DURATION_PURGE_INTERVAL = 86400
 
 logger = logging.getLogger(__name__)
 
+# Replayed state of the snapshot + log, keyed on both files' (mtime, size) so
+# they are only re-read when they change on disk.
+_CACHE = {"key": None, "data": {}, "lines": 0, "frozen": None}
+_LOCK = asyncio.Lock()
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _read_snapshot() -> dict:
+    try:
+        with open(MUTED_CHANNELS_FILE, 'rb') as f:
+            content = f.read().strip()
+        if not content:
+            return {}
+        data = orjson.loads(content)
+        # Backward compatibility: if it's a list, convert to dict with unknown names
+        if isinstance(data, list):
+            return {cid: "Unknown Channel" for cid in data}
+        return data
+    except FileNotFoundError:
+        return {}
+    except orjson.JSONDecodeError:
+        logger.warning(f"Corrupted muted channels file found at {MUTED_CHANNELS_FILE}. Ignoring it.")
+        return {}
+
+def _replay_log(data: dict) -> int:
+    """Applies the log entries to data in order, returning the number of lines read."""
+    lines = 0
+    try:
+        with open(MUTED_CHANNELS_LOG, 'rb') as f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    logger.warning(f"Skipping corrupted line {lines} in {MUTED_CHANNELS_LOG}")
+                    continue
+                if entry.get("op") == "add":
+                    data[entry["id"]] = entry.get("name", "Unknown Channel")
+                elif entry.get("op") == "del":
+                    data.pop(entry["id"], None)
+    except FileNotFoundError:
+        pass
+    return lines
+
 def load_muted_channels_dict() -> dict:
     """Loads the dictionary of muted channels {id: name}."""
-    if not os.path.exists(MUTED_CHANNELS_FILE):
+    key = (_stat_key(MUTED_CHANNELS_FILE), _stat_key(MUTED_CHANNELS_LOG))
+    if key == (None, None):
         return {}
+    if key == _CACHE["key"]:
+        return _CACHE["data"]
+
     try:
-        with open(MUTED_CHANNELS_FILE, 'r') as f:
-            content = f.read().strip()
-            if not content:
-                return {}
-            data = json.loads(content)
-            # Backward compatibility: if it's a list, convert to dict with unknown names
-            if isinstance(data, list):
-                return {cid: "Unknown Channel" for cid in data}
-            return data
-    except json.JSONDecodeError:
-        logger.warning(f"Corrupted muted channels file found at {MUTED_CHANNELS_FILE}. Returning empty dict.")
-        return {}
+        data = _read_snapshot()
+        lines = _replay_log(data)
     except Exception as e:
         logger.error(f"Error loading muted channels: {e}")
         return {}
 
-def load_muted_channels() -> set:
-    """Loads the set of muted channel IDs (for filtering)."""
-    return set(load_muted_channels_dict().keys())
+    _CACHE["key"] = key
+    _CACHE["data"] = data
+    _CACHE["lines"] = lines
+    _CACHE["frozen"] = None
+    return data
 
-def mute_channel(channel_id: str, channel_title: str = "Unknown Channel") -> bool:
-    """Adds a channel ID and title to the muted list."""
-    muted = load_muted_channels_dict()
-    muted[channel_id] = channel_title
-    try:
-        with open(MUTED_CHANNELS_FILE, 'w') as f:
-            json.dump(muted, f, indent=2)
-        return True
-    except Exception as e:
-        logger.error(f"Error saving muted channels: {e}")
-        return False
+async def _compact(data: dict):
+    """Writes data as the new snapshot and truncates the log."""
+    tmp_path = MUTED_CHANNELS_FILE + '.tmp'
+    async with aiofiles.open(tmp_path, 'wb') as f:
+        await f.write(orjson.dumps(data))
+    os.replace(tmp_path, MUTED_CHANNELS_FILE)
+    os.remove(MUTED_CHANNELS_LOG)
+    _CACHE["lines"] = 0
 
-def unmute_channel(channel_id: str) -> bool:
-    """Removes a channel from the muted list."""
-    muted = load_muted_channels_dict()
-    if channel_id in muted:
-        del muted[channel_id]
+async def _append(entry: dict) -> bool:
+    """Appends a single mute/unmute entry to the log and applies it to the cache."""
+    async with _LOCK:
+        # Applied to a copy that then replaces the cached dict: readers in the
+        # threadpool may be iterating the old one, and _LOCK doesn't stop them.
+        muted = dict(load_muted_channels_dict())
         try:
-            with open(MUTED_CHANNELS_FILE, 'w') as f:
-                json.dump(muted, f, indent=2)
-            return True
+            async with aiofiles.open(MUTED_CHANNELS_LOG, 'ab') as f:
+                await f.write(orjson.dumps(entry) + b'\n')
         except Exception as e:
             logger.error(f"Error saving muted channels: {e}")
             return False
-    return True
+
+        if entry["op"] == "add":
+            muted[entry["id"]] = entry["name"]
+        else:
+            muted.pop(entry["id"], None)
+        _CACHE["data"] = muted
+        _CACHE["lines"] += 1
+        _CACHE["frozen"] = None
+
+        if _CACHE["lines"] > COMPACT_THRESHOLD:
+            try:
+                await _compact(muted)
+            except Exception as e:
+                # The log is still intact, so nothing is lost; retry on the next write.
+                logger.error(f"Error compacting muted channels: {e}")
+        _CACHE["key"] = (_stat_key(MUTED_CHANNELS_FILE), _stat_key(MUTED_CHANNELS_LOG))
+        return True
+
+def load_muted_channels() -> frozenset:
+    """Loads the set of muted channel IDs (for filtering)."""
+    data = load_muted_channels_dict()
+    if data is not _CACHE["data"]:
+        # Nothing on disk, so nothing cached either
+        return frozenset(data)
+    # Built once per change to the muted list rather than on every feed
+    if _CACHE["frozen"] is None:
+        _CACHE["frozen"] = frozenset(data)
+    return _CACHE["frozen"]
+
+async def mute_channel(channel_id: str, channel_title: str = "Unknown Channel") -> bool:
+    """Adds a channel ID and title to the muted list."""
+    return await _append({"op": "add", "id": channel_id, "name": channel_title})
+
+async def unmute_channel(channel_id: str) -> bool:
+    """Removes a channel from the muted list."""
+    if channel_id not in load_muted_channels_dict():
+        return True
+    return await _append({"op": "del", "id": channel_id})
+
+# sqlite3 connections can't be shared between threads, so each thread keeps its own
+_DB_LOCAL = threading.local()
+# Stays below SQLite's limit on bound parameters per statement
+_SQL_CHUNK = 500
+_PURGE_LOCK = threading.Lock()
+_PURGE_STATE = {"last": 0.0}
+
+def _durations_db():
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is None:
+        # The path is read once, when the thread opens its connection
+        path = settings.VIDEO_DURATIONS_DB
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        except OSError:
+            pass  # sqlite3.connect then fails, and the caller logs that
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS video_durations "
+            "(video_id TEXT PRIMARY KEY, duration INTEGER NOT NULL, ts INTEGER NOT NULL)"
+        )
+        _DB_LOCAL.conn = conn
+    return conn
+
+def load_video_durations(video_ids) -> dict:
+    """Returns the cached durations {video_id: seconds} for the given IDs, skipping expired ones."""
+    durations = {}
+    video_ids = list(video_ids)
+    min_ts = int(time.time()) - DURATION_CACHE_TTL
+    try:
+        conn = _durations_db()
+        for i in range(0, len(video_ids), _SQL_CHUNK):
+            chunk = video_ids[i:i+_SQL_CHUNK]
+            rows = conn.execute(
+                f"SELECT video_id, duration FROM video_durations "
+                f"WHERE ts >= ? AND video_id IN ({','.join('?' * len(chunk))})",
+                (min_ts, *chunk)
+            )
+            durations.update(rows)
+    except sqlite3.Error as e:
+        logger.error(f"Error loading cached video durations: {e}")
+    return durations
+
+def save_video_durations(durations: dict):
+    """Caches durations {video_id: seconds}. Zero durations (live or upcoming videos) are not stored."""
+    now = int(time.time())
+    rows = [(vid, seconds, now) for vid, seconds in durations.items() if seconds > 0]
+    if not rows:
+        return
+    try:
+        conn = _durations_db()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO video_durations VALUES (?, ?, ?)", rows)
+    except sqlite3.Error as e:
+        logger.error(f"Error saving video durations: {e}")
+        return
+    purge_video_durations()
+
+def purge_video_durations(force: bool = False):
+    """Deletes expired durations; runs at most once per DURATION_PURGE_INTERVAL unless forced."""
+    # Only one thread purges; the others carry on rather than wait for it
+    if not _PURGE_LOCK.acquire(blocking=False):
+        return
+    try:
+        now = time.time()
+        if not force and now - _PURGE_STATE["last"] < DURATION_PURGE_INTERVAL:
+            return
+        _PURGE_STATE["last"] = now
+        conn = _durations_db()
+        with conn:
+            deleted = conn.execute(
+                "DELETE FROM video_durations WHERE ts < ?", (int(now) - DURATION_CACHE_TTL,)
+            ).rowcount
+        if deleted:
+            logger.info(f"Purged {deleted} expired video durations")
+    except sqlite3.Error as e:
+        logger.error(f"Error purging video durations: {e}")
+    finally:
+        _PURGE_LOCK.release()
@@ -1,18 +1,80 @@
+import asyncio
 import logging
 import re
-from youtube_transcript_api import YouTubeTranscriptApi
-from openai import OpenAI
-import google.generativeai as genai
+import threading
+from cachetools import LRUCache
 from ..config import settings
 from .youtube import get_video_details
 
 logger = logging.getLogger(__name__)
 
-def get_video_summary(video_id: str, youtube_client=None) -> str:
+# Matches a leading ```html / ``` fence or a trailing ``` fence around the LLM output
+_CODE_FENCE_RE = re.compile(r'^```(?:html)?\s*|\s*```$', re.IGNORECASE)
+
+# LLM clients are configured once, on first use. The SDKs (and the transcript API)
+# are imported lazily too: genai pulls in grpc + protobuf, and workers that never
+# serve a summary shouldn't pay for them at startup or in memory.
+_gemini_model = None
+_openai_client = None
+
+def _get_gemini_model():
+    global _gemini_model
+    if _gemini_model is None:
+        import google.generativeai as genai
+        genai.configure(api_key=settings.GEMINI_API_KEY)
+        _gemini_model = genai.GenerativeModel('gemini-2.0-flash')
+    return _gemini_model
+
+def _get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        from openai import OpenAI
+        _openai_client = OpenAI(api_key=settings.OPENAI_API_KEY)
+    return _openai_client
+
+# Successful summaries by video_id; a video's transcript and summary don't change,
+# so revisits skip the transcript fetch and the LLM call. Errors are never cached.
+_SUMMARY_CACHE = LRUCache(maxsize=1024)
+_SUMMARY_LOCK = threading.Lock()
+
+# Content beyond this many characters is cut before prompting the LLM
+MAX_CONTENT_CHARS = 10000
+
+def _join_transcript(transcript_list) -> str:
+    """Joins transcript segments, stopping once there is more text than we will send."""
+    parts = []
+    length = -1  # length of " ".join(parts)
+    for t in transcript_list:
+        text = t['text']
+        parts.append(text)
+        length += len(text) + 1
+        if length > MAX_CONTENT_CHARS:
+            break
+    return " ".join(parts)
+
+# In-flight summary tasks by video_id, so duplicate requests share one generation
+_INFLIGHT = {}
+
+async def get_video_summary(video_id: str, youtube_client=None) -> str:
     """Fetches transcript and generates a summary using Gemini (Free) or OpenAI."""
     if not settings.GEMINI_API_KEY and not settings.OPENAI_API_KEY:
         return "Error: No API Key set. Please set GEMINI_API_KEY (Free) or OPENAI_API_KEY in .env"
 
+    with _SUMMARY_LOCK:
+        cached = _SUMMARY_CACHE.get(video_id)
+    if cached is not None:
+        return cached
+
+    task = _INFLIGHT.get(video_id)
+    if task is None:
+        task = asyncio.create_task(asyncio.to_thread(_generate_summary, video_id, youtube_client))
+        _INFLIGHT[video_id] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(video_id, None))
+    # Shielded so one caller disconnecting doesn't cancel the others' result
+    return await asyncio.shield(task)
+
+def _generate_summary(video_id: str, youtube_client=None) -> str:
+    """Blocking part of get_video_summary: transcript fetch and LLM call."""
     full_text = None
     source_note = ""
     
@@ -30,6 +92,8 @@ def get_video_summary(video_id: str, youtube_client=None) -> str:
 
     # 1. Try to get Transcript
     try:
+        from youtube_transcript_api import YouTubeTranscriptApi
+
         # Try to fetch transcript directly
         try:
             transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
@@ -45,7 +109,7 @@ def get_video_summary(video_id: str, youtube_client=None) -> str:
             else:
                 raise Exception("list_transcripts not supported in this version")
             
-        full_text = " ".join([t['text'] for t in transcript_list])
+        full_text = _join_transcript(transcript_list)
         
     except Exception as e:
         logger.warning(f"Transcript fetch failed: {e}")
@@ -62,8 +126,8 @@ def get_video_summary(video_id: str, youtube_client=None) -> str:
         return "No content available to summarize."
 
     # Truncate if too long
-    if len(full_text) > 10000:
-        full_text = full_text[:10000] + "..."
+    if len(full_text) > MAX_CONTENT_CHARS:
+        full_text = full_text[:MAX_CONTENT_CHARS] + "..."
 
     # Construct Prompt
     system_instruction = (
@@ -89,10 +153,8 @@ def get_video_summary(video_id: str, youtube_client=None) -> str:
         response_text = ""
         if settings.GEMINI_API_KEY:
             try:
-                genai.configure(api_key=settings.GEMINI_API_KEY)
-                model = genai.GenerativeModel('gemini-2.0-flash') 
                 final_prompt = f"{system_instruction}\n\n{prompt_text}"
-                response = model.generate_content(final_prompt)
+                response = _get_gemini_model().generate_content(final_prompt)
                 response_text = response.text
             except Exception as e:
                 logger.error(f"Gemini Error: {e}")
@@ -100,8 +162,7 @@ def get_video_summary(video_id: str, youtube_client=None) -> str:
                     return f"Gemini Error: {str(e)}"
         
         if not response_text and settings.OPENAI_API_KEY:
-            client = OpenAI(api_key=settings.OPENAI_API_KEY)
-            response = client.chat.completions.create(
+            response = _get_openai_client().chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[
                     {"role": "system", "content": system_instruction},
@@ -113,10 +174,11 @@ def get_video_summary(video_id: str, youtube_client=None) -> str:
         # Strip markdown code blocks if present
         if response_text:
             # Remove ```html ... ``` or just ``` ... ```
-            response_text = re.sub(r'^```html\s*', '', response_text, flags=re.IGNORECASE)
-            response_text = re.sub(r'^```\s*', '', response_text)
-            response_text = re.sub(r'\s*```$', '', response_text)
-            return response_text.strip() + source_note
+            response_text = _CODE_FENCE_RE.sub('', response_text)
+            summary = response_text.strip() + source_note
+            with _SUMMARY_LOCK:
+                _SUMMARY_CACHE[video_id] = summary
+            return summary
             
         return "Error: Could not generate summary."
 
@@ -1,46 +1,68 @@
+import logging
 import re
-import asyncio
-import httpx
+from .storage import load_video_durations, save_video_durations
+
+logger = logging.getLogger(__name__)
+
+# Videos up to this many seconds long are treated as Shorts
+SHORTS_MAX_DURATION = 60
+
+# Compiled once; YouTube durations look like PT1H2M10S, or P1DT2H for
+# streams longer than a day, and P0D for live/upcoming videos.
+_DURATION_RE = re.compile(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
 
 def parse_duration(duration: str) -> int:
     """Parses YouTube duration string (e.g., PT1H2M10S) to seconds."""
     if not duration:
         return 0
-    match = re.match(r'PT(\d+H)?(\d+M)?(\d+S)?', duration)
+    match = _DURATION_RE.match(duration)
     if not match:
         return 0
     
-    hours = int(match.group(1)[:-1]) if match.group(1) else 0
-    minutes = int(match.group(2)[:-1]) if match.group(2) else 0
-    seconds = int(match.group(3)[:-1]) if match.group(3) else 0
-    
-    return hours * 3600 + minutes * 60 + seconds
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes or 0) * 60 + int(seconds or 0)
+
+def get_video_durations(youtube, video_ids):
+    """Fetches durations for a list of video IDs, only asking the API for ones not cached on disk."""
+    durations = load_video_durations(video_ids)
+    missing = [vid for vid in video_ids if vid not in durations]
+
+    fetched = {}
+    # Batch in 50s
+    for i in range(0, len(missing), 50):
+        batch = missing[i:i+50]
+        try:
+            request = youtube.videos().list(
+                part="contentDetails",
+                id=",".join(batch),
+                fields="items(id,contentDetails/duration)"
+            )
+            response = request.execute()
+            for item in response.get("items", []):
+                fetched[item["id"]] = parse_duration(item["contentDetails"]["duration"])
+        except Exception as e:
+            logger.error(f"Error fetching durations: {e}")
+
+    save_video_durations(fetched)
+    durations.update(fetched)
+    return durations
+
+# Creators tag most Shorts with #shorts in the title
+_SHORTS_TAG_RE = re.compile(r'#shorts\b', re.IGNORECASE)
 
-async def check_is_short_parallel(video_ids):
+def check_is_short_batch(youtube, video_ids, titles=None) -> set:
     """
-    Checks if videos are Shorts by making parallel HEAD requests to youtube.com/shorts/{video_id}.
-    Returns a set of video_ids that are confirmed Shorts.
+    Checks if videos are Shorts using their durations from get_video_durations.
+    Videos whose title (from the optional {video_id: title} map) carries a #shorts tag
+    are taken as Shorts without a lookup.
+    Returns a set of video_ids no longer than SHORTS_MAX_DURATION seconds. Zero
+    durations (P0D: live and upcoming videos) are not Shorts.
     """
     shorts_set = set()
-    
-    async def check_single(client, vid):
-        try:
-            # Follow redirects=False. 
-            # If it's a Short, it returns 200 OK.
-            # If it's a Video, it returns 303 See Other (redirect to /watch).
-            resp = await client.head(f"https://www.youtube.com/shorts/{vid}", follow_redirects=False)
-            if resp.status_code == 200:
-                return vid
-        except Exception:
-            pass
-        return None
-
-    async with httpx.AsyncClient() as client:
-        tasks = [check_single(client, vid) for vid in video_ids]
-        results = await asyncio.gather(*tasks)
-        
-    for res in results:
-        if res:
-            shorts_set.add(res)
-            
+    if titles:
+        shorts_set = {vid for vid in video_ids if _SHORTS_TAG_RE.search(titles.get(vid, ""))}
+        video_ids = [vid for vid in video_ids if vid not in shorts_set]
+
+    durations = get_video_durations(youtube, video_ids)
+    shorts_set.update(vid for vid, seconds in durations.items() if 0 < seconds <= SHORTS_MAX_DURATION)
     return shorts_set
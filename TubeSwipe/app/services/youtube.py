@@ -1,20 +1,154 @@
+import asyncio
+import hashlib
+import heapq
 import logging
+import os
+import threading
 import time
+import weakref
 from datetime import datetime, timedelta, timezone
-from googleapiclient.discovery import build
+import httplib2
+import google_auth_httplib2
+import orjson
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import HttpRequest
 from google.oauth2.credentials import Credentials
-from .utils import parse_duration, check_is_short_parallel
+from cachetools import TTLCache
+from .utils import check_is_short_batch
+# Moved to utils; imported here only to keep app.services.youtube.get_video_durations working
+from .utils import get_video_durations  # noqa: F401
 from .storage import load_muted_channels
 from ..config import settings
 
 logger = logging.getLogger(__name__)
 
-# Simple In-Memory Cache
-FEED_CACHE = {
-    "data": None,
-    "timestamp": 0
-}
+# Built feeds per (user_id, include_shorts), stored as encoded JSON. user_id is
+# the account's channel ID, so every session of the same user shares one entry.
 CACHE_DURATION = 300  # 5 minutes in seconds
+FEED_CACHE = TTLCache(maxsize=1024, ttl=CACHE_DURATION)
+# One lock per cache key, so concurrent misses collapse into one rebuild
+_FEED_LOCKS = weakref.WeakValueDictionary()
+
+# Saved status (video_id -> playlists) per user_id. Playlists only change when
+# the user saves a video, which invalidates the entry (see invalidate_saved_map).
+SAVED_MAP_TTL = 1800  # 30 minutes in seconds
+SAVED_MAP_CACHE = TTLCache(maxsize=1024, ttl=SAVED_MAP_TTL)
+
+# The bundled discovery document never changes at runtime; read it once instead
+# of on every build().
+_DISCOVERY_DOC = get_static_doc('youtube', 'v3')
+
+# On-disk HTTP cache, under settings.HTTP_CACHE_DIR. API responses carry ETags,
+# so httplib2 revalidates cached entries with If-None-Match and a 304 is served
+# from here without a body. Revalidation rewrites the entry, so file mtimes
+# track last use; unused entries are pruned by age, then oldest-first by size.
+HTTP_CACHE_MAX_AGE = 7 * 86400  # 7 days in seconds
+HTTP_CACHE_MAX_BYTES = 200 * 1024 * 1024
+HTTP_CACHE_PRUNE_INTERVAL = 3600  # 1 hour in seconds
+_PRUNE_LOCK = threading.Lock()
+_PRUNE_STATE = {"last": 0.0}
+# Cache directory -> its FileCache, for as long as some client still uses it;
+# pruning never removes these.
+_LIVE_CACHES = weakref.WeakValueDictionary()
+
+class _UserFileCache(httplib2.FileCache):
+    """
+    FileCache that never breaks a request: entries are written atomically (clients
+    share the cache across threads), a directory removed underneath it is
+    recreated, and any other disk error just skips caching that response.
+    """
+
+    def set(self, key, value):
+        path = os.path.join(self.cache, self.safe(key))
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            try:
+                f = open(tmp_path, "wb")
+            except FileNotFoundError:
+                os.makedirs(self.cache, mode=0o700, exist_ok=True)
+                f = open(tmp_path, "wb")
+            with f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write HTTP cache entry: {e}")
+            _remove_quietly(tmp_path)
+
+    def delete(self, key):
+        _remove_quietly(os.path.join(self.cache, self.safe(key)))
+
+def _http_cache_for(token_info: dict):
+    """
+    One cache directory per user (keyed by their channel ID, which survives token
+    rotation), so cached `mine=True` responses never cross accounts.
+    """
+    user_id = token_info.get('user_id')
+    if not user_id:
+        return None
+    user_key = hashlib.sha256(user_id.encode()).hexdigest()[:32]
+    path = os.path.join(settings.HTTP_CACHE_DIR, user_key)
+    # The cache holds users' API responses, so keep it private to this account
+    os.makedirs(settings.HTTP_CACHE_DIR, mode=0o700, exist_ok=True)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    cache = _LIVE_CACHES.get(path)
+    if cache is None:
+        cache = _LIVE_CACHES[path] = _UserFileCache(path)
+    return cache
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def prune_http_cache(force=False):
+    """
+    Deletes cached responses unused for HTTP_CACHE_MAX_AGE, then the least recently
+    used ones until the cache fits in HTTP_CACHE_MAX_BYTES, and drops empty user
+    directories no live client uses. Runs at most once per HTTP_CACHE_PRUNE_INTERVAL
+    unless forced.
+    """
+    if not _PRUNE_LOCK.acquire(blocking=False):
+        return
+    try:
+        now = time.time()
+        if not force and now - _PRUNE_STATE["last"] < HTTP_CACHE_PRUNE_INTERVAL:
+            return
+        _PRUNE_STATE["last"] = now
+
+        files = []
+        for root, _, names in os.walk(settings.HTTP_CACHE_DIR):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if now - st.st_mtime > HTTP_CACHE_MAX_AGE:
+                    _remove_quietly(path)
+                else:
+                    files.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        files.sort()
+        for _, size, path in files:
+            if total <= HTTP_CACHE_MAX_BYTES:
+                break
+            _remove_quietly(path)
+            total -= size
+
+        with os.scandir(settings.HTTP_CACHE_DIR) as entries:
+            for entry in entries:
+                if entry.is_dir() and entry.path not in _LIVE_CACHES:
+                    try:
+                        os.rmdir(entry.path)  # Only succeeds when empty
+                    except OSError:
+                        pass
+    except FileNotFoundError:
+        pass
+    finally:
+        _PRUNE_LOCK.release()
 
 def get_youtube_client(token_info: dict):
     # If we are in mock mode (passed via token_info or detected otherwise), return None
@@ -27,9 +161,40 @@ def get_youtube_client(token_info: dict):
         token_uri="https://oauth2.googleapis.com/token",
         client_id=token_info['client_id'],
         client_secret=token_info['client_secret'],
-        scopes=token_info['scopes']
+        scopes=token_info['scopes'],
+        expiry=token_info.get('expiry')
+    )
+
+    # httplib2.Http is not thread-safe, and clients are shared across requests
+    # (see client_cache), so every thread gets its own connection.
+    # The FileCache itself is shared; it writes one file per URL. Pruning runs
+    # first, so it can't remove the directory this client is about to use.
+    if token_info.get('user_id'):
+        prune_http_cache()
+    cache = _http_cache_for(token_info)
+    local = threading.local()
+
+    def build_request(http, *args, **kwargs):
+        if not hasattr(local, "http"):
+            local.http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(cache=cache))
+        return HttpRequest(local.http, *args, **kwargs)
+
+    return build_from_document(
+        _DISCOVERY_DOC,
+        http=google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(cache=cache)),
+        requestBuilder=build_request
     )
-    return build('youtube', 'v3', credentials=creds)
+
+def get_own_channel_id(creds):
+    """The signed-in user's channel ID, used as a stable per-user key (1 quota unit)."""
+    try:
+        youtube = build_from_document(_DISCOVERY_DOC, credentials=creds)
+        response = youtube.channels().list(part="id", mine=True, fields="items/id").execute()
+        items = response.get("items", [])
+        return items[0]["id"] if items else None
+    except Exception as e:
+        logger.error(f"Error fetching own channel id: {e}")
+        return None
 
 def get_mock_feed():
     """Returns fake video data for testing without API keys."""
@@ -63,103 +228,153 @@ def get_mock_feed():
 def get_subscriptions(youtube):
     """Fetch user's subscriptions (first 50)."""
     request = youtube.subscriptions().list(
-        part="snippet,contentDetails",
+        part="snippet",
         mine=True,
-        maxResults=50
+        maxResults=50,
+        fields="items(snippet/resourceId/channelId)"
     )
     response = request.execute()
     return response.get("items", [])
 
 def get_uploads_playlist_ids(youtube, channel_ids):
     """Get the uploads playlist ID for a list of channels."""
+    # A channel's uploads playlist is its ID with UC swapped for UU, so only
+    # IDs that don't follow that pattern need an API call.
+    playlist_ids = []
+    unknown_ids = []
+    for cid in channel_ids:
+        if cid.startswith("UC"):
+            playlist_ids.append("UU" + cid[2:])
+        else:
+            unknown_ids.append(cid)
+    if not unknown_ids:
+        return playlist_ids
+
     # API allows batching up to 50 ids
-    ids_string = ",".join(channel_ids)
+    ids_string = ",".join(unknown_ids)
     request = youtube.channels().list(
         part="contentDetails",
-        id=ids_string
+        id=ids_string,
+        fields="items(contentDetails/relatedPlaylists/uploads)"
     )
     response = request.execute()
     
-    playlist_ids = []
     for item in response.get("items", []):
         uploads_id = item["contentDetails"]["relatedPlaylists"]["uploads"]
         playlist_ids.append(uploads_id)
     return playlist_ids
 
-def get_recent_videos_from_playlists(youtube, playlist_ids):
-    """Fetch the most recent video from each playlist."""
-    videos = []
+# Google's batch endpoint accepts at most 50 calls per HTTP request
+BATCH_LIMIT = 50
+# Batches in flight at once across the app, to stay within per-minute quota
+BATCH_CONCURRENCY = 8
+_BATCH_SEMAPHORE = asyncio.Semaphore(BATCH_CONCURRENCY)
+def _execute_batch(batch, credentials):
+    """
+    Executes a batch on its own connection, closed afterwards. The batched calls
+    carry the http of the thread that built them, which must not be shared with
+    a worker thread; one round-trip per batch makes a fresh connection cheap.
+    """
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+    try:
+        batch.execute(http=http)
+    finally:
+        http.close()
+
+async def execute_batched(youtube, requests):
+    """
+    Executes API requests through batch HTTP requests, 50 calls per round-trip,
+    with up to BATCH_CONCURRENCY batches running in parallel.
+    Returns the responses in the same order as requests, with None for failed calls.
+    """
+    responses = [None] * len(requests)
+
+    # Called from the worker threads; each call writes its own slot.
+    def callback(request_id, response, exception):
+        if exception is not None:
+            logger.error(f"Error in batched request {request_id}: {exception}")
+            return
+        responses[int(request_id)] = response
+
+    async def run(start):
+        batch = youtube.new_batch_http_request(callback=callback)
+        for i in range(start, min(start + BATCH_LIMIT, len(requests))):
+            batch.add(requests[i], request_id=str(i))
+        async with _BATCH_SEMAPHORE:
+            try:
+                await asyncio.to_thread(_execute_batch, batch, requests[start].http.credentials)
+            except Exception as e:
+                logger.error(f"Error executing batch request: {e}")
+
+    await asyncio.gather(*(run(start) for start in range(0, len(requests), BATCH_LIMIT)))
+    return responses
+
+# Only the snippet fields the feed uses
+_RECENT_VIDEO_FIELDS = (
+    "items(snippet(publishedAt,channelId,title,channelTitle,"
+    "thumbnails/high/url,resourceId/videoId))"
+)
+
+def _published_at(video):
+    return video["snippet"].get("publishedAt", "")
+
+async def get_recent_videos_from_playlists(youtube, playlist_ids):
+    """Fetch the most recent videos from each playlist, batched, as one newest-first list per playlist."""
     # Note: This is expensive on quota (1 unit per call). 
-    # 50 subs = 50 calls = 50 units.
+    # 50 subs = 50 calls = 50 units, but only one HTTP round-trip.
     # In production, you would cache this or use a worker.
-    
-    for pid in playlist_ids:
-        try:
-            request = youtube.playlistItems().list(
-                part="snippet,contentDetails",
-                playlistId=pid,
-                maxResults=5  # Fetch last 5 videos
-            )
-            response = request.execute()
-            items = response.get("items", [])
-            if items:
-                videos.extend(items)
-        except Exception as e:
-            logger.error(f"Error fetching playlist {pid}: {e}")
-            continue
-            
-    return videos
+    requests = [
+        youtube.playlistItems().list(
+            part="snippet",
+            playlistId=pid,
+            maxResults=5,  # Fetch last 5 videos
+            fields=_RECENT_VIDEO_FIELDS
+        )
+        for pid in playlist_ids
+    ]
+    responses = await execute_batched(youtube, requests)
+    per_playlist = [response.get("items", []) for response in responses if response]
+    # Uploads already come newest-first, so this is a linear check; it only
+    # reorders the odd playlist that isn't, keeping the merge in _build_feed valid.
+    for items in per_playlist:
+        items.sort(key=_published_at, reverse=True)
+    return per_playlist
 
-def get_playlist_video_ids(youtube, playlist_id):
-    """Fetches video IDs from the playlist."""
-    if youtube is None:
-        return set()
-        
-    video_ids = set()
-    next_page_token = None
+async def get_playlists_video_ids(youtube, playlist_ids):
+    """Fetches video IDs for several playlists at once, as {playlist_id: set of video IDs}."""
+    video_ids = {pid: set() for pid in playlist_ids}
+    # Playlist -> token of its next page. Each round fetches one page of every
+    # playlist that still has one, in batched requests.
+    pending = {pid: None for pid in playlist_ids}
     
-    # Limit to first 500 (10 pages) to catch more videos
-    # This is a trade-off between performance and accuracy
-    for _ in range(10): 
-        try:
-            request = youtube.playlistItems().list(
+    # Limit to the first 500 videos (10 pages) of each playlist: a trade-off
+    # between performance and accuracy
+    for _ in range(10):
+        if not pending:
+            break
+        pids = list(pending)
+        requests = [
+            youtube.playlistItems().list(
                 part="contentDetails",
-                playlistId=playlist_id,
+                playlistId=pid,
                 maxResults=50,
-                pageToken=next_page_token
+                pageToken=pending[pid],
+                fields="items/contentDetails/videoId,nextPageToken"
             )
-            response = request.execute()
-            
+            for pid in pids
+        ]
+        pending = {}
+        for pid, response in zip(pids, await execute_batched(youtube, requests)):
+            if response is None:
+                continue
             for item in response.get("items", []):
-                video_ids.add(item["contentDetails"]["videoId"])
-                
+                video_ids[pid].add(item["contentDetails"]["videoId"])
             next_page_token = response.get("nextPageToken")
-            if not next_page_token:
-                break
-        except Exception as e:
-            logger.error(f"Error fetching playlist items: {e}")
-            break
+            if next_page_token:
+                pending[pid] = next_page_token
             
     return video_ids
 
-def get_video_durations(youtube, video_ids):
-    """Fetches durations for a list of video IDs."""
-    durations = {}
-    # Batch in 50s
-    for i in range(0, len(video_ids), 50):
-        batch = video_ids[i:i+50]
-        try:
-            request = youtube.videos().list(
-                part="contentDetails",
-                id=",".join(batch)
-            )
-            response = request.execute()
-            for item in response.get("items", []):
-                durations[item["id"]] = parse_duration(item["contentDetails"]["duration"])
-        except Exception as e:
-            logger.error(f"Error fetching durations: {e}")
-    return durations
-
 def get_video_details(youtube, video_id):
     """Fetches video title and description using the official API."""
     if youtube is None:
@@ -167,7 +382,8 @@ def get_video_details(youtube, video_id):
     try:
         request = youtube.videos().list(
             part="snippet",
-            id=video_id
+            id=video_id,
+            fields="items/snippet(title,channelTitle,description)"
         )
         response = request.execute()
         if response["items"]:
@@ -186,7 +402,8 @@ def get_or_create_playlist(youtube, title="TubeSwipe Saved"):
     request = youtube.playlists().list(
         part="snippet",
         mine=True,
-        maxResults=50
+        maxResults=50,
+        fields="items(id,snippet/title)"
     )
     response = request.execute()
     
@@ -252,7 +469,8 @@ def get_user_playlists(youtube):
                 part="snippet,status",
                 mine=True,
                 maxResults=50,
-                pageToken=next_page_token
+                pageToken=next_page_token,
+                fields="items(id,snippet/title,snippet/thumbnails/default/url,status/privacyStatus),nextPageToken"
             )
             response = request.execute()
             
@@ -304,35 +522,49 @@ def create_playlist(youtube, title, privacy_status="private", description="Creat
         logger.error(f"Error creating playlist: {e}")
         return None
 
-async def get_feed(youtube, include_shorts=True, check_playlist_id=None, force_refresh=False):
-    """Orchestrate the feed generation with caching."""
-    global FEED_CACHE
-    
-    # Check Cache (only if not forcing refresh and no specific playlist filter)
-    cache_key = f"shorts:{include_shorts}"
-    
-    print(f"[CACHE DEBUG] Request: key={cache_key}, force_refresh={force_refresh}, playlist_id={check_playlist_id}")
-    print(f"[CACHE DEBUG] Cache state: has_data={bool(FEED_CACHE['data'])}, stored_key={FEED_CACHE.get('key')}, age={time.time() - FEED_CACHE['timestamp']:.1f}s")
-    
-    if not force_refresh and not check_playlist_id and FEED_CACHE["data"]:
-        # Check if key matches (so we don't serve non-shorts feed when shorts requested)
-        if FEED_CACHE.get("key") == cache_key:
-            current_time = time.time()
-            age = current_time - FEED_CACHE["timestamp"]
-            if age < CACHE_DURATION:
-                print(f"[CACHE DEBUG] ✓ CACHE HIT! Serving {len(FEED_CACHE['data'])} videos from cache")
-                logger.info("Serving feed from cache")
-                return FEED_CACHE["data"]
-            else:
-                print(f"[CACHE DEBUG] ✗ Cache expired (age: {age:.1f}s > limit: {CACHE_DURATION}s)")
-        else:
-            print(f"[CACHE DEBUG] ✗ Cache key mismatch: stored={FEED_CACHE.get('key')} vs requested={cache_key}")
-    else:
-        print(f"[CACHE DEBUG] ✗ Cache miss reasons: force={force_refresh}, playlist={check_playlist_id}, has_data={bool(FEED_CACHE['data'])}")
+async def _build_saved_video_map(youtube):
+    """Maps every video in the user's playlists to the playlists containing it."""
+    saved_video_map = {} # video_id -> list of {'id', 'title'} playlists
+    playlists = await asyncio.to_thread(get_user_playlists, youtube)
 
-    if youtube is None:
-        return get_mock_feed()
+    # Check all playlists in batched requests
+    ids_by_playlist = await get_playlists_video_ids(youtube, [pl['id'] for pl in playlists])
+    # Each playlist is visited once and its ids are a set, so no playlist is
+    # appended twice for the same video.
+    for pl in playlists:
+        entry = {'id': pl['id'], 'title': pl['title']}
+        for vid in ids_by_playlist[pl['id']]:
+            saved_video_map.setdefault(vid, []).append(entry)
+    return saved_video_map
+
+async def get_saved_video_map(youtube, user_id=None):
+    """Same as _build_saved_video_map, cached per user_id when one is given."""
+    if user_id is not None:
+        saved_video_map = SAVED_MAP_CACHE.get(user_id)
+        if saved_video_map is not None:
+            return saved_video_map
+
+    saved_video_map = await _build_saved_video_map(youtube)
+    if user_id is not None:
+        SAVED_MAP_CACHE[user_id] = saved_video_map
+    return saved_video_map
+
+async def _get_saved_video_map_or_empty(youtube, user_id):
+    """get_saved_video_map for the feed, where a failure just means no saved status."""
+    try:
+        return await get_saved_video_map(youtube, user_id)
+    except Exception as e:
+        logger.error(f"Error fetching user playlists: {e}")
+        return {}
 
+def invalidate_saved_map(user_id):
+    """Drops the cached saved status, and the feeds built from it, after the user's playlists changed."""
+    SAVED_MAP_CACHE.pop(user_id, None)
+    for include_shorts in (True, False):
+        FEED_CACHE.pop((user_id, include_shorts), None)
+
+async def _build_feed(youtube, include_shorts, user_id=None):
+    """Builds the feed from the API, without caching."""
     # 1. Get Subs
     subs = get_subscriptions(youtube)
     if not subs:
@@ -345,105 +577,107 @@ async def get_feed(youtube, include_shorts=True, check_playlist_id=None, force_r
     upload_playlist_ids = get_uploads_playlist_ids(youtube, channel_ids)
     
     # 4. Get Recent Videos
-    raw_videos = get_recent_videos_from_playlists(youtube, upload_playlist_ids)
-    
+    per_playlist = await get_recent_videos_from_playlists(youtube, upload_playlist_ids)
+    # 5. Merge the sorted playlists by Date (newest first), no full sort needed
+    raw_videos = list(heapq.merge(*per_playlist, key=_published_at, reverse=True))
 
+    if not raw_videos:
+        return []
 
-    # Filter Muted Channels
-    muted_channels = load_muted_channels()
-    raw_videos = [v for v in raw_videos if v["snippet"]["channelId"] not in muted_channels]
+    # The Shorts check and the saved status are independent API work, so both
+    # run at once; the saved map is then ready by the time the feed is formatted.
+    shorts_task = None
+    if not include_shorts and youtube:
+        titles = {v["snippet"]["resourceId"]["videoId"]: v["snippet"]["title"] for v in raw_videos}
+        # Batched duration check, skipping videos already tagged #shorts
+        shorts_task = asyncio.to_thread(check_is_short_batch, youtube, list(titles), titles)
+    saved_task = _get_saved_video_map_or_empty(youtube, user_id)
 
-    # Filter by Date (Last 48 Hours)
-    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=48)
-    
-    filtered_videos = []
-    for v in raw_videos:
-        try:
-            # publishedAt is like "2023-10-25T10:00:00Z"
-            pub_str = v["snippet"]["publishedAt"]
-            # Handle Z for UTC
-            if pub_str.endswith('Z'):
-                pub_str = pub_str[:-1] + '+00:00'
-            
-            pub_date = datetime.fromisoformat(pub_str)
-            
-            if pub_date >= cutoff_time:
-                filtered_videos.append(v)
-        except Exception as e:
-            logger.warning(f"Error parsing date for video {v.get('id')}: {e}")
-            # Keep it if we can't parse it, or drop it? Let's drop to be safe/clean.
-            continue
-            
-    raw_videos = filtered_videos
+    if shorts_task is None:
+        shorts_ids, saved_video_map = set(), await saved_task
+    else:
+        shorts_ids, saved_video_map = await asyncio.gather(shorts_task, saved_task)
 
-    # Filter Shorts if requested
-    if not include_shorts and youtube:
-        video_ids = [v["snippet"]["resourceId"]["videoId"] for v in raw_videos]
-        
-        # Parallel Check
-        shorts_ids = await check_is_short_parallel(video_ids)
-        
-        # Filter out confirmed Shorts
-        raw_videos = [v for v in raw_videos if v["snippet"]["resourceId"]["videoId"] not in shorts_ids]
+    # Filter Muted Channels, by Date (Last 48 Hours) and Shorts in one pass.
+    # publishedAt is fixed-format UTC ("2023-10-25T10:00:00Z"), so ISO strings
+    # compare in date order. Videos without a date compare below the cutoff.
+    muted_channels = load_muted_channels()
+    cutoff_iso = (datetime.now(timezone.utc) - timedelta(hours=48)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    raw_videos = [
+        v for v in raw_videos
+        if (snippet := v["snippet"]).get("publishedAt", "") >= cutoff_iso
+        and snippet["channelId"] not in muted_channels
+        and snippet["resourceId"]["videoId"] not in shorts_ids
+    ]
 
-    # 5. Sort by Date (newest first)
-    raw_videos.sort(
-        key=lambda x: x["snippet"]["publishedAt"], 
-        reverse=True
-    )
-    
     # 6. Format & Check Saved Status across ALL playlists
     formatted_videos = []
-    saved_video_map = {} # video_id -> list of playlist titles
-    
-    if youtube:
-        try:
-            # Fetch all user playlists
-            playlists = get_user_playlists(youtube)
-            
-            # Check each playlist
-            for pl in playlists:
-                try:
-                    p_ids = get_playlist_video_ids(youtube, pl['id'])
-                    for vid in p_ids:
-                        if vid not in saved_video_map:
-                            saved_video_map[vid] = []
-                        
-                        # Check if this playlist ID is already in the list for this video
-                        if not any(p['id'] == pl['id'] for p in saved_video_map[vid]):
-                            saved_video_map[vid].append({'id': pl['id'], 'title': pl['title']})
-                            
-                except Exception as e:
-                    logger.warning(f"Could not fetch items for playlist {pl['title']}: {e}")
-        except Exception as e:
-            logger.error(f"Error fetching user playlists: {e}")
-
     for video in raw_videos:
-        vid_id = video["snippet"]["resourceId"]["videoId"]
+        snippet = video["snippet"]
+        vid_id = snippet["resourceId"]["videoId"]
         
-        # Determine saved status
-        is_saved = vid_id in saved_video_map
-        saved_to = saved_video_map.get(vid_id, [])
+        # Determine saved status; () serializes as an empty list
+        saved_to = saved_video_map.get(vid_id, ())
         
         formatted_videos.append({
             "video_id": vid_id,
-            "title": video["snippet"]["title"],
-            "channel_title": video["snippet"]["channelTitle"],
-            "thumbnail_url": video["snippet"]["thumbnails"]["high"]["url"],
-            "published_at": video["snippet"]["publishedAt"],
-            "channel_id": video["snippet"]["channelId"],
-            "saved": is_saved,
+            "title": snippet["title"],
+            "channel_title": snippet["channelTitle"],
+            "thumbnail_url": snippet["thumbnails"]["high"]["url"],
+            "published_at": snippet["publishedAt"],
+            "channel_id": snippet["channelId"],
+            "saved": bool(saved_to),
             "saved_to": saved_to
         })
         
-    # Update Cache (only if not filtering by playlist)
-    if not check_playlist_id:
-        FEED_CACHE["data"] = formatted_videos
-        FEED_CACHE["timestamp"] = time.time()
-        FEED_CACHE["key"] = cache_key
-        print(f"[CACHE DEBUG] ✓ Cache updated: {len(formatted_videos)} videos, key={cache_key}")
-        logger.info(f"Feed cache updated. Items: {len(formatted_videos)}")
-    else:
-        print(f"[CACHE DEBUG] ✗ Not caching (playlist filter active: {check_playlist_id})")
-        
     return formatted_videos
+
+async def get_feed_json(youtube, include_shorts=True, check_playlist_id=None, force_refresh=False, user_id=None) -> bytes:
+    """
+    Orchestrate the feed generation with caching, returning the feed as JSON bytes.
+    Feeds are cached per (user_id, include_shorts) already encoded, so a cache hit
+    needs no serialization; without a user_id, or with a playlist filter, the feed
+    is built fresh and not cached.
+    """
+    if youtube is None:
+        return orjson.dumps(get_mock_feed())
+
+    cacheable = user_id is not None and not check_playlist_id
+    cache = FEED_CACHE
+    cache_key = (user_id, include_shorts)
+    # Hit path: one lookup and no lock
+    if cacheable and not force_refresh:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Serving feed from cache (include_shorts=%s)", include_shorts)
+            return cached
+
+    if force_refresh and user_id is not None:
+        invalidate_saved_map(user_id)
+
+    if not cacheable:
+        return orjson.dumps(await _build_feed(youtube, include_shorts, user_id))
+
+    lock = _FEED_LOCKS.get(cache_key)
+    if lock is None:
+        lock = _FEED_LOCKS[cache_key] = asyncio.Lock()
+
+    # Concurrent misses for the same key wait for a single rebuild
+    async with lock:
+        if not force_refresh:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.debug("Serving feed from cache (include_shorts=%s)", include_shorts)
+                return cached
+
+        formatted_videos = await _build_feed(youtube, include_shorts, user_id)
+        cache[cache_key] = encoded = orjson.dumps(formatted_videos)
+        logger.debug("Feed cache updated. Items: %d", len(formatted_videos))
+        return encoded
+
+async def get_feed(youtube, include_shorts=True, check_playlist_id=None, force_refresh=False, user_id=None):
+    """Same as get_feed_json, decoded into a list of video dicts."""
+    return orjson.loads(await get_feed_json(
+        youtube, include_shorts=include_shorts, check_playlist_id=check_playlist_id,
+        force_refresh=force_refresh, user_id=user_id
+    ))
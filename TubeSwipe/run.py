@@ -5,4 +5,20 @@ import sys
 if __name__ == "__main__":
     # Ensure we are running from the correct directory
     sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-    uvicorn.run("app.main:app", host="127.0.0.1", port=8000, reload=True)
+
+    # The file watcher is for development; set RELOAD=false in production.
+    reload = os.getenv("RELOAD", "True").lower() == "true"
+    # Sessions and caches live in process memory, so extra workers don't share them.
+    workers = int(os.getenv("WORKERS", "1"))
+
+    # loop/http "auto" pick uvloop and httptools when installed (uvicorn[standard])
+    # and fall back to asyncio and h11 where they aren't, e.g. uvloop on Windows.
+    uvicorn.run(
+        "app.main:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="auto",
+        http="auto",
+        reload=reload,
+        workers=None if reload else workers
+    )
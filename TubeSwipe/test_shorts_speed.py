@@ -15,11 +15,17 @@ VIDEO_IDS = [
 # We'll use real IDs repeated to ensure valid network responses
 TEST_BATCH = ["dQw4w9WgXcQ", "jNQXAC9IVRw", "9bZkp7q19f0"] * 7 # 21 videos
 
+# One pooled client for the whole batch, sized so every probe gets a kept-alive
+# connection instead of its own handshake. With HTTP/2 the probes are
+# multiplexed over a single connection to youtube.com (needs httpx[http2]).
+CLIENT_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+CLIENT_TIMEOUT = httpx.Timeout(5.0)
+
 async def check_is_short(client, video_id):
     url = f"https://www.youtube.com/shorts/{video_id}"
     try:
-        # Follow redirects=False to see the 303
-        resp = await client.head(url, follow_redirects=False)
+        # The client doesn't follow redirects, so we see the 303
+        resp = await client.head(url)
         # If 200, it's a Short. If 303 (See Other) -> /watch, it's a Video.
         is_short = resp.status_code == 200
         return video_id, is_short, resp.status_code
@@ -30,7 +36,7 @@ async def main():
     print(f"Testing batch of {len(TEST_BATCH)} videos...")
     start_time = time.time()
     
-    async with httpx.AsyncClient() as client:
+    async with httpx.AsyncClient(http2=True, follow_redirects=False, limits=CLIENT_LIMITS, timeout=CLIENT_TIMEOUT) as client:
         tasks = [check_is_short(client, vid) for vid in TEST_BATCH]
         results = await asyncio.gather(*tasks)
         
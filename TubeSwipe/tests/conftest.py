@@ -1,18 +1,36 @@
+import threading
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
 from app.config import settings
+from app.services import storage
 
-@pytest.fixture
-def client():
+class MockYouTube:
+    pass
+
+@pytest.fixture(scope="session")
+def app_client():
     # Force mock mode for tests
     settings.MOCK_MODE = True
+    # Started once for the whole run instead of per test
     with TestClient(app) as c:
         yield c
 
 @pytest.fixture
+def client(app_client):
+    # Every test starts logged out, even though the client is shared
+    app_client.cookies.clear()
+    yield app_client
+
+@pytest.fixture(scope="session")
 def mock_youtube_client():
     # Return a mock object if needed for direct service testing
-    class MockYouTube:
-        pass
     return MockYouTube()
+
+@pytest.fixture(autouse=True)
+def isolated_duration_cache(tmp_path, monkeypatch):
+    # Keep the on-disk duration cache out of the project root and between tests
+    monkeypatch.setattr(settings, "VIDEO_DURATIONS_DB", str(tmp_path / "video_durations.db"))
+    # Fresh per-thread connections, so they open the patched path
+    monkeypatch.setattr(storage, "_DB_LOCAL", threading.local())
+    monkeypatch.setattr(settings, "HTTP_CACHE_DIR", str(tmp_path / "http"))
@@ -56,3 +56,9 @@ def test_swipe_action(client: TestClient):
     response = client.post("/api/swipe", json={"video_id": "123", "action": "save"})
     assert response.status_code == 200
     assert response.json()["status"] == "saved"
+
+def test_swipe_invalid_action(client: TestClient):
+    client.get("/auth/callback?mock=true")
+
+    response = client.post("/api/swipe", json={"video_id": "123", "action": "maybe"})
+    assert response.status_code == 422
@@ -1,5 +1,7 @@
+import asyncio
+import time
 import pytest
-from app.services.utils import parse_duration, check_is_short_parallel
+from app.services.utils import parse_duration, check_is_short_batch
 from app.services.youtube import get_mock_feed
 
 def test_parse_duration():
@@ -8,6 +10,8 @@ def test_parse_duration():
     assert parse_duration("PT10S") == 10
     assert parse_duration("") == 0
     assert parse_duration("INVALID") == 0
+    assert parse_duration("P1DT2H") == 93600
+    assert parse_duration("P0D") == 0
 
 def test_get_mock_feed():
     feed = get_mock_feed()
@@ -15,25 +19,99 @@ def test_get_mock_feed():
     assert len(feed) > 0
     assert "video_id" in feed[0]
 
-@pytest.mark.asyncio
-async def test_check_is_short_parallel():
-    # We mock httpx to avoid real network calls
-    # But for a quick integration test, we can try with known IDs if network is allowed,
-    # or better, mock the response.
-    
-    # For now, let's just test the function structure with a mock
-    # Since we can't easily mock inside the function without dependency injection or patching,
-    # we will rely on the fact that it returns a set.
-    
-    # Real network test (optional, can be flaky):
-    # res = await check_is_short_parallel(["dQw4w9WgXcQ"]) # Rick Roll is NOT a short
-    # assert "dQw4w9WgXcQ" not in res
-    pass
+def test_check_is_short_batch():
+    from unittest.mock import MagicMock
+    mock_youtube = MagicMock()
+    mock_youtube.videos().list().execute.return_value = {
+        "items": [
+            {"id": "short1", "contentDetails": {"duration": "PT45S"}},
+            {"id": "short2", "contentDetails": {"duration": "PT1M"}},
+            {"id": "video1", "contentDetails": {"duration": "PT10M3S"}},
+        ]
+    }
+
+    assert check_is_short_batch(mock_youtube, ["short1", "short2", "video1"]) == {"short1", "short2"}
+    assert check_is_short_batch(mock_youtube, []) == set()
+
+    # Titles tagged #shorts are resolved without a lookup
+    mock_youtube.videos().list.reset_mock()
+    mock_youtube.videos().list().execute.return_value = {
+        "items": [{"id": "short3", "contentDetails": {"duration": "PT45S"}}]
+    }
+    titles = {"tagged": "Wait for it #Shorts", "short3": "Plain title"}
+    assert check_is_short_batch(mock_youtube, ["tagged", "short3"], titles) == {"tagged", "short3"}
+    assert mock_youtube.videos().list.call_args.kwargs["id"] == "short3"
+
+    # Live and upcoming videos report P0D and are not Shorts
+    mock_youtube.videos().list().execute.return_value = {
+        "items": [{"id": "live1", "contentDetails": {"duration": "P0D"}}]
+    }
+    assert check_is_short_batch(mock_youtube, ["live1"]) == set()
+
+def test_get_video_durations_cached_on_disk():
+    from unittest.mock import MagicMock
+    from app.services.utils import get_video_durations
+    mock_youtube = MagicMock()
+    mock_youtube.videos().list.reset_mock()
+    mock_youtube.videos().list().execute.return_value = {
+        "items": [
+            {"id": "video1", "contentDetails": {"duration": "PT10M"}},
+            {"id": "live1", "contentDetails": {"duration": "P0D"}},
+        ]
+    }
+    assert get_video_durations(mock_youtube, ["video1", "live1"]) == {"video1": 600, "live1": 0}
+
+    # Only the uncached (and live, uncacheable) video is fetched again
+    mock_youtube.videos().list.reset_mock()
+    mock_youtube.videos().list().execute.return_value = {"items": []}
+    assert get_video_durations(mock_youtube, ["video1", "live1"]) == {"video1": 600}
+    assert mock_youtube.videos().list.call_args.kwargs["id"] == "live1"
+
+def test_expired_video_durations_are_purged():
+    import time
+    from app.services import storage
+    storage.save_video_durations({"old1": 60, "new1": 120})
+    conn = storage._durations_db()
+    with conn:
+        conn.execute("UPDATE video_durations SET ts = ? WHERE video_id = 'old1'",
+                     (int(time.time()) - storage.DURATION_CACHE_TTL - 1,))
+
+    storage.purge_video_durations(force=True)
+    assert [r[0] for r in conn.execute("SELECT video_id FROM video_durations")] == ["new1"]
 
 from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock, patch
 from app.services.youtube import get_feed
 
+class FakeBatch:
+    """Stands in for BatchHttpRequest: runs each added request and reports it to the callback."""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        for request_id, request in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+def test_get_uploads_playlist_ids_derived():
+    from app.services.youtube import get_uploads_playlist_ids
+    mock_youtube = MagicMock()
+    mock_youtube.channels().list().execute.return_value = {
+        "items": [{"contentDetails": {"relatedPlaylists": {"uploads": "UUodd"}}}]
+    }
+    mock_youtube.channels().list.reset_mock()
+
+    assert get_uploads_playlist_ids(mock_youtube, ["UC123", "UC456"]) == ["UU123", "UU456"]
+    mock_youtube.channels().list.assert_not_called()
+
+    # IDs without the UC prefix fall back to the API
+    assert get_uploads_playlist_ids(mock_youtube, ["UC123", "HCodd"]) == ["UU123", "UUodd"]
+    assert mock_youtube.channels().list.call_args.kwargs["id"] == "HCodd"
+
 @pytest.mark.asyncio
 async def test_get_feed_date_filter():
     # Mock dependencies
@@ -76,17 +154,290 @@ async def test_get_feed_date_filter():
         "items": [recent_video, old_video]
     }
     
+    mock_youtube.new_batch_http_request.side_effect = FakeBatch
+    
     # Mock user playlists (empty)
     mock_youtube.playlists().list().execute.return_value = {"items": []}
 
     # Run get_feed
     # We need to mock load_muted_channels to avoid file I/O
     with patch("app.services.youtube.load_muted_channels", return_value=set()):
-        # We also need to mock check_is_short_parallel to avoid network calls
-        with patch("app.services.youtube.check_is_short_parallel", return_value=set()):
+        # We also need to mock check_is_short_batch to avoid network calls
+        with patch("app.services.youtube.check_is_short_batch", return_value=set()):
              videos = await get_feed(mock_youtube, include_shorts=True, force_refresh=True)
              
     # Assertions
     assert len(videos) == 1
     assert videos[0]["video_id"] == "vid1"
 
+
+@pytest.mark.asyncio
+async def test_muted_channels_roundtrip(tmp_path, monkeypatch):
+    from app.services import storage
+    monkeypatch.setattr(storage, "MUTED_CHANNELS_FILE", str(tmp_path / "muted_channels.json"))
+    monkeypatch.setattr(storage, "MUTED_CHANNELS_LOG", str(tmp_path / "muted_channels.jsonl"))
+    monkeypatch.setattr(storage, "_CACHE", {"key": None, "data": {}, "lines": 0, "frozen": None})
+
+    assert storage.load_muted_channels_dict() == {}
+    assert await storage.mute_channel("UC1", "Channel 1")
+    assert await storage.mute_channel("UC2", "Channel 2")
+    assert await storage.unmute_channel("UC1")
+    assert storage.load_muted_channels_dict() == {"UC2": "Channel 2"}
+    assert storage.load_muted_channels() == {"UC2"}
+    assert storage.load_muted_channels() is storage.load_muted_channels()
+
+@pytest.mark.asyncio
+async def test_muted_channels_log_compaction(tmp_path, monkeypatch):
+    from app.services import storage
+    monkeypatch.setattr(storage, "MUTED_CHANNELS_FILE", str(tmp_path / "muted_channels.json"))
+    monkeypatch.setattr(storage, "MUTED_CHANNELS_LOG", str(tmp_path / "muted_channels.jsonl"))
+    monkeypatch.setattr(storage, "_CACHE", {"key": None, "data": {}, "lines": 0, "frozen": None})
+    monkeypatch.setattr(storage, "COMPACT_THRESHOLD", 2)
+
+    for i in range(3):
+        assert await storage.mute_channel(f"UC{i}", f"Channel {i}")
+
+    # The third write crosses the threshold and folds the log into the snapshot
+    assert not (tmp_path / "muted_channels.jsonl").exists()
+    expected = {"UC0": "Channel 0", "UC1": "Channel 1", "UC2": "Channel 2"}
+    assert storage.load_muted_channels_dict() == expected
+
+    # A cold start replays snapshot + log from disk
+    await storage.mute_channel("UC3", "Channel 3")
+    monkeypatch.setattr(storage, "_CACHE", {"key": None, "data": {}, "lines": 0, "frozen": None})
+    assert storage.load_muted_channels_dict() == {**expected, "UC3": "Channel 3"}
+
+@pytest.mark.asyncio
+async def test_ensure_fresh_token_single_flight():
+    from app import auth
+    from app.middleware import build_token_info
+
+    class ExpiringCreds:
+        token = "old_token"
+        refresh_token = "refresh"
+        scopes = []
+        expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=10)
+
+    token_info = build_token_info(auth.store_credentials(ExpiringCreds()))
+    refreshes = []
+
+    def fake_refresh(self, request):
+        refreshes.append(1)
+        self.token = "new_token"
+        self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+
+    with patch.object(auth.Credentials, "refresh", fake_refresh):
+        results = await asyncio.gather(*[auth.ensure_fresh_token(token_info) for _ in range(5)])
+
+    # Concurrent requests for the same session share one refresh
+    assert len(refreshes) == 1
+    assert {r["access_token"] for r in results} == {"new_token"}
+
+@pytest.mark.asyncio
+async def test_ensure_fresh_token_before_google_auth_threshold():
+    from app import auth
+    from app.middleware import build_token_info
+
+    class SoonExpiringCreds:
+        token = "old_token"
+        refresh_token = "refresh"
+        scopes = []
+        expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(minutes=2)
+
+    token_info = build_token_info(auth.store_credentials(SoonExpiringCreds()))
+    # google-auth already treats this token as expired...
+    stale = auth.Credentials(token="old_token", expiry=SoonExpiringCreds.expiry)
+    assert not stale.valid
+
+    def fake_refresh(self, request):
+        self.token = "new_token"
+        self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+
+    # ...so the store must refresh it too, before the client would on its own
+    with patch.object(auth.Credentials, "refresh", fake_refresh):
+        fresh = await auth.ensure_fresh_token(token_info)
+    assert fresh["access_token"] == "new_token"
+    assert auth.get_stored_credentials(token_info["sid"])["token"] == "new_token"
+
+@pytest.mark.asyncio
+async def test_get_video_summary_single_flight(monkeypatch):
+    from app.services import summary
+    monkeypatch.setattr(summary.settings, "GEMINI_API_KEY", "test_key")
+    calls = []
+
+    def fake_generate(video_id, youtube_client=None):
+        calls.append(video_id)
+        time.sleep(0.05)
+        return "<ul><li>Summary</li></ul>"
+
+    with patch("app.services.summary._generate_summary", fake_generate):
+        results = await asyncio.gather(*[summary.get_video_summary("vid_sf") for _ in range(3)])
+
+    # Duplicate in-flight requests share one generation
+    assert calls == ["vid_sf"]
+    assert results == ["<ul><li>Summary</li></ul>"] * 3
+    assert "vid_sf" not in summary._INFLIGHT
+
+@pytest.mark.asyncio
+async def test_get_playlists_video_ids_pages_in_batches():
+    from app.services.youtube import get_playlists_video_ids
+    mock_youtube = MagicMock()
+    mock_youtube.new_batch_http_request.side_effect = FakeBatch
+    mock_youtube.playlistItems().list().execute.side_effect = [
+        {"items": [{"contentDetails": {"videoId": "vid1"}}], "nextPageToken": "page2"},
+        {"items": [{"contentDetails": {"videoId": "vid2"}}]},
+    ]
+
+    assert await get_playlists_video_ids(mock_youtube, ["PL1"]) == {"PL1": {"vid1", "vid2"}}
+    assert mock_youtube.new_batch_http_request.call_count == 2
+
+@pytest.mark.asyncio
+async def test_execute_batched_keeps_order_across_batches():
+    from app.services.youtube import execute_batched
+    mock_youtube = MagicMock()
+    mock_youtube.new_batch_http_request.side_effect = FakeBatch
+    requests = []
+    for i in range(120):
+        request = MagicMock()
+        request.execute.return_value = {"n": i}
+        requests.append(request)
+
+    responses = await execute_batched(mock_youtube, requests)
+
+    assert [r["n"] for r in responses] == list(range(120))
+    assert mock_youtube.new_batch_http_request.call_count == 3
+
+@pytest.mark.asyncio
+async def test_get_feed_cached_per_user():
+    from app.services import youtube as yt
+    built = []
+
+    async def fake_build(youtube, include_shorts, user_id=None):
+        built.append(include_shorts)
+        return [{"video_id": f"vid{len(built)}"}]
+
+    with patch.object(yt, "FEED_CACHE", yt.TTLCache(maxsize=16, ttl=60)):
+        with patch("app.services.youtube._build_feed", fake_build):
+            first = await get_feed(MagicMock(), include_shorts=True, user_id="user1")
+            assert await get_feed(MagicMock(), include_shorts=True, user_id="user1") == first
+            # Other users and settings get their own entries
+            assert await get_feed(MagicMock(), include_shorts=True, user_id="user2") != first
+            assert await get_feed(MagicMock(), include_shorts=False, user_id="user1") != first
+            # Explicit refresh rebuilds
+            assert await get_feed(MagicMock(), include_shorts=True, user_id="user1", force_refresh=True) != first
+
+    assert len(built) == 4
+
+@pytest.mark.asyncio
+async def test_build_feed_saved_map():
+    from app.services import youtube as yt
+    now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+    video = {
+        "snippet": {
+            "resourceId": {"videoId": "vid1"},
+            "title": "Video",
+            "channelTitle": "Channel 1",
+            "thumbnails": {"high": {"url": "http://thumb"}},
+            "publishedAt": now,
+            "channelId": "UC123"
+        }
+    }
+    playlists = [{"id": "PL1", "title": "Later"}, {"id": "PL2", "title": "Music"}]
+    ids_by_playlist = {"PL1": {"vid1", "other"}, "PL2": {"other"}}
+
+    async def fake_recent(youtube, playlist_ids):
+        return [[video]]
+
+    with patch.object(yt, "get_subscriptions", return_value=[{"snippet": {"resourceId": {"channelId": "UC123"}}}]), \
+         patch.object(yt, "get_uploads_playlist_ids", return_value=["UU123"]), \
+         patch.object(yt, "get_recent_videos_from_playlists", fake_recent), \
+         patch.object(yt, "load_muted_channels", return_value=frozenset()), \
+         patch.object(yt, "get_user_playlists", return_value=playlists), \
+         patch.object(yt, "get_playlists_video_ids", return_value=ids_by_playlist) as get_ids, \
+         patch.object(yt, "SAVED_MAP_CACHE", yt.TTLCache(maxsize=16, ttl=60)):
+        videos = await yt._build_feed(MagicMock(), include_shorts=True, user_id="user1")
+        # The saved map is cached per user until invalidated
+        await yt._build_feed(MagicMock(), include_shorts=True, user_id="user1")
+        assert get_ids.call_count == 1
+        yt.invalidate_saved_map("user1")
+        await yt._build_feed(MagicMock(), include_shorts=True, user_id="user1")
+        assert get_ids.call_count == 2
+
+    assert videos[0]["saved"] is True
+    assert videos[0]["saved_to"] == [{"id": "PL1", "title": "Later"}]
+
+def test_prune_http_cache(monkeypatch):
+    import os
+    from app.config import settings
+    from app.services import youtube as yt
+    user_dir = os.path.join(settings.HTTP_CACHE_DIR, "user")
+    stale_dir = os.path.join(settings.HTTP_CACHE_DIR, "stale_user")
+    os.makedirs(user_dir)
+    os.makedirs(stale_dir)
+    now = time.time()
+    for path, age in [(os.path.join(stale_dir, "a"), 8 * 86400),
+                      (os.path.join(user_dir, "old"), 2 * 86400),
+                      (os.path.join(user_dir, "new"), 60)]:
+        with open(path, "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(path, (now - age, now - age))
+
+    # Over the size cap, the least recently used entry goes first
+    monkeypatch.setattr(yt, "HTTP_CACHE_MAX_BYTES", 150)
+    yt.prune_http_cache(force=True)
+
+    assert os.listdir(user_dir) == ["new"]
+    assert not os.path.exists(stale_dir)
+
+def test_http_cache_survives_first_prune():
+    import os
+    import httplib2
+    from app.config import settings
+    from app.services import youtube as yt
+    yt._PRUNE_STATE["last"] = 0.0
+    token_info = {
+        "access_token": "token", "refresh_token": "refresh", "user_id": "UCuser",
+        "client_id": "id", "client_secret": "secret", "scopes": [],
+    }
+    # First build in the process prunes; the new user's directory must survive it
+    youtube = yt.get_youtube_client(token_info)
+    assert len(os.listdir(settings.HTTP_CACHE_DIR)) == 1
+
+    sent_headers = []
+
+    def fake_conn_request(self, conn, request_uri, method, body, headers):
+        sent_headers.append(dict(headers))
+        if "if-none-match" in headers:
+            return httplib2.Response({"status": "304", "etag": '"v1"'}), b""
+        return httplib2.Response({
+            "status": "200", "etag": '"v1"', "content-type": "application/json",
+            "cache-control": "private, max-age=0, must-revalidate",
+        }), b'{"items": [{"id": "sub1"}]}'
+
+    with patch.object(httplib2.Http, "_conn_request", fake_conn_request):
+        first = youtube.subscriptions().list(part="snippet", mine=True).execute()
+        # Revalidated with the stored ETag and served from the cache on 304
+        second = youtube.subscriptions().list(part="snippet", mine=True).execute()
+
+    assert first == second == {"items": [{"id": "sub1"}]}
+    assert sent_headers[1]["if-none-match"] == '"v1"'
+
+def test_http_cache_recreates_missing_directory():
+    import shutil
+    from app.services import youtube as yt
+    cache = yt._http_cache_for({"user_id": "UCother"})
+    shutil.rmtree(cache.cache)
+    cache.set("key", b"value")
+    assert cache.get("key") == b"value"
+
+def test_execute_batch_closes_its_connection():
+    from app.services import youtube as yt
+    batch = MagicMock()
+    with patch.object(yt.google_auth_httplib2, "AuthorizedHttp") as authorized_http:
+        batch.execute.side_effect = RuntimeError("network down")
+        with pytest.raises(RuntimeError):
+            yt._execute_batch(batch, MagicMock())
+
+    http = authorized_http.return_value
+    batch.execute.assert_called_once_with(http=http)
+    http.close.assert_called_once()